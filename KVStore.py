@@ -1,4 +1,10 @@
+import functools
+import hashlib
+import importlib.metadata
+import inspect
+import os
 import time
+from typing import Tuple, Union
 
 import concrete.numpy as cnp
 import numpy as np
@@ -7,6 +13,8 @@ import numpy as np
 NUMBER_OF_ENTRIES = 5
 CHUNK_SIZE = 4
 
+BATCH_SIZE = 2
+
 KEY_SIZE = 32
 VALUE_SIZE = 32
 
@@ -16,17 +24,19 @@ assert VALUE_SIZE % CHUNK_SIZE == 0
 NUMBER_OF_KEY_CHUNKS = KEY_SIZE // CHUNK_SIZE
 NUMBER_OF_VALUE_CHUNKS = VALUE_SIZE // CHUNK_SIZE
 
-STATE_SHAPE = (NUMBER_OF_ENTRIES, 1 + NUMBER_OF_KEY_CHUNKS + NUMBER_OF_VALUE_CHUNKS)
+SHIFT = 1 << CHUNK_SIZE
 
-FLAG = 0
-KEY = slice(1, 1 + NUMBER_OF_KEY_CHUNKS)
-VALUE = slice(1 + NUMBER_OF_KEY_CHUNKS, None)
+FLAGS_SHAPE = (NUMBER_OF_ENTRIES,)
+KEYS_SHAPE = (NUMBER_OF_ENTRIES, NUMBER_OF_KEY_CHUNKS)
+VALUES_SHAPE = (NUMBER_OF_ENTRIES, NUMBER_OF_VALUE_CHUNKS)
 
 
 def encode(number: int, width: int) -> np.array:
-    binary_repr = np.binary_repr(number, width=width)
-    blocks = [binary_repr[i:i+CHUNK_SIZE] for i in range(0, len(binary_repr), CHUNK_SIZE)]
-    return np.array([int(block, 2) for block in blocks])
+    if not 0 <= number < 1 << width:
+        raise ValueError(f"{number} is not a non-negative integer that fits in {width} bits")
+
+    shifts = np.arange(width - CHUNK_SIZE, -CHUNK_SIZE, -CHUNK_SIZE)
+    return (number >> shifts) & ((1 << CHUNK_SIZE) - 1)
 
 def encode_key(number: int) -> np.array:
     return encode(number, width=KEY_SIZE)
@@ -35,17 +45,16 @@ def encode_value(number: int) -> np.array:
     return encode(number, width=VALUE_SIZE)
 
 def decode(encoded_number: np.array) -> int:
-    result = 0
-    for i in range(len(encoded_number)):
-        result += 2**(CHUNK_SIZE*i) * encoded_number[(len(encoded_number) - i) - 1]
-    return result
+    shifts = np.arange(len(encoded_number) - 1, -1, -1) * CHUNK_SIZE
+    return int((np.asarray(encoded_number, dtype=np.int64) << shifts).sum())
 
+def split_state(state: np.array) -> Tuple[np.array, np.array, np.array]:
+    return state[:, 0], state[:, 1:1 + NUMBER_OF_KEY_CHUNKS], state[:, 1 + NUMBER_OF_KEY_CHUNKS:]
 
-keep_selected_lut = cnp.LookupTable([0 for _ in range(16)] + [i for i in range(16)])
 
-def _insert_impl(state, key, value):
-    flags = state[:, FLAG]
+keep_selected_lut = cnp.LookupTable([0 for _ in range(SHIFT)] + [i for i in range(SHIFT)])
 
+def _insert_impl(flags, keys, values, key, value):
     selection = cnp.zeros(NUMBER_OF_ENTRIES)
 
     found = cnp.zero()
@@ -56,153 +65,300 @@ def _insert_impl(state, key, value):
         selection[i] = is_selected
         found += is_selected
 
-    state_update = cnp.zeros(STATE_SHAPE)
-    state_update[:, FLAG] = selection
+    new_flags = flags + selection
 
     selection = selection.reshape((-1, 1))
 
-    packed_selection_and_key = (selection * (2 ** CHUNK_SIZE)) + key
-    key_update = keep_selected_lut[packed_selection_and_key]
+    key_and_value = np.concatenate([key, value])
+    packed_selection_and_key_and_value = selection * SHIFT + key_and_value
+    key_and_value_update = keep_selected_lut[packed_selection_and_key_and_value]
 
-    packed_selection_and_value = selection * (2 ** CHUNK_SIZE) + value
-    value_update = keep_selected_lut[packed_selection_and_value]
+    new_keys = keys + key_and_value_update[:, :NUMBER_OF_KEY_CHUNKS]
+    new_values = values + key_and_value_update[:, NUMBER_OF_KEY_CHUNKS:]
 
-    state_update[:, KEY] = key_update
-    state_update[:, VALUE] = value_update
+    return np.concatenate([new_flags.reshape((-1, 1)), new_keys, new_values], axis=1)
 
-    new_state = state + state_update
-    return new_state
+def _replace_and_query_impl(keys, values, key, value):
+    mismatches = np.sum((keys - key) != 0, axis=1)
+    selection = (mismatches == 0).reshape((-1, 1))
+    found = np.sum(selection, axis=0, keepdims=True)
 
-def _replace_impl(state, key, value):
-    keys = state[:, KEY]
-    values = state[:, VALUE]
+    packed_selection_and_values = selection * SHIFT + values
+    value_selection = keep_selected_lut[packed_selection_and_values]
+    queried_value = np.sum(value_selection, axis=0, keepdims=True)
 
-    selection = (np.sum((keys - key) == 0, axis=1) == NUMBER_OF_KEY_CHUNKS).reshape((-1, 1))
-    packed_selection_and_value = selection * (2 ** CHUNK_SIZE) + value
+    packed_selection_and_value = selection * SHIFT + value
     set_value = keep_selected_lut[packed_selection_and_value]
 
-    inverse_selection = 1 - selection
-    packed_inverse_selection_and_values = inverse_selection * (2 ** CHUNK_SIZE) + values
-    kept_values = keep_selected_lut[packed_inverse_selection_and_values]
-
+    kept_values = values - value_selection
     new_values = kept_values + set_value
-    state[:, VALUE] = new_values
 
-    return state
+    entries = np.concatenate([selection, new_values], axis=1)
+    query_result = np.concatenate([found, queried_value], axis=1)
+    return np.concatenate([entries, query_result], axis=0)
 
-def _query_impl(state, key):
-    keys = state[:, KEY]
-    values = state[:, VALUE]
+def _insert_many_impl(flags, keys, values, batch_keys, batch_values):
+    unused = 1 - flags
 
-    selection = (np.sum((keys - key) == 0, axis=1) == NUMBER_OF_KEY_CHUNKS).reshape((-1, 1))
-    found = np.sum(selection)
+    rank = cnp.zeros(NUMBER_OF_ENTRIES)
+    running = cnp.zero()
+    for i in range(NUMBER_OF_ENTRIES):
+        running += unused[i]
+        rank[i] = running
 
-    packed_selection_and_values = selection * (2 ** CHUNK_SIZE) + values
-    value_selection = keep_selected_lut[packed_selection_and_values]
-    value = np.sum(value_selection, axis=0)
+    packed_rank_and_unused = rank * 2 + unused
+    targets = (np.arange(BATCH_SIZE) * 2 + 3).reshape((-1, 1))
+    selection = (packed_rank_and_unused - targets) == 0
 
-    return cnp.array([found, *value])
+    new_flags = flags + np.sum(selection, axis=0)
 
+    selection = selection.reshape((BATCH_SIZE, NUMBER_OF_ENTRIES, 1))
+    batch_keys_and_values = np.concatenate([batch_keys, batch_values], axis=1).reshape(
+        (BATCH_SIZE, 1, NUMBER_OF_KEY_CHUNKS + NUMBER_OF_VALUE_CHUNKS)
+    )
 
-class KeyValueDatabase:
+    packed_selection_and_keys_and_values = selection * SHIFT + batch_keys_and_values
+    key_and_value_update = np.sum(keep_selected_lut[packed_selection_and_keys_and_values], axis=0)
 
-    _state: np.ndarray
+    new_keys = keys + key_and_value_update[:, :NUMBER_OF_KEY_CHUNKS]
+    new_values = values + key_and_value_update[:, NUMBER_OF_KEY_CHUNKS:]
 
-    _insert_circuit: cnp.Circuit
-    _replace_circuit: cnp.Circuit
-    _query_circuit: cnp.Circuit
+    return np.concatenate([new_flags.reshape((-1, 1)), new_keys, new_values], axis=1)
 
-    def __init__(self):
-        self._state = np.zeros(STATE_SHAPE, dtype=np.int64)
+def _query_many_impl(keys, values, batch_keys):
+    batch_keys = batch_keys.reshape((BATCH_SIZE, 1, NUMBER_OF_KEY_CHUNKS))
+    mismatches = np.sum((keys - batch_keys) != 0, axis=2)
+    selection = (mismatches == 0).reshape((BATCH_SIZE, NUMBER_OF_ENTRIES, 1))
+    found = np.sum(selection, axis=1)
 
-        inputset_binary = [
-            (
-                np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-            )
-        ]
-        inputset_ternary = [
-            (
-                np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # value
-            )
-        ]
+    packed_selection_and_values = selection * SHIFT + values
+    value_selection = keep_selected_lut[packed_selection_and_values]
+    value = np.sum(value_selection, axis=1)
 
-        configuration = cnp.Configuration(
-            enable_unsafe_features=True,
-            use_insecure_key_cache=True,
-            insecure_key_cache_location=".keys",
-        )
+    return np.concatenate([found, value], axis=1)
 
-        insert_compiler = cnp.Compiler(
-            _insert_impl,
-            {"state": "encrypted", "key": "encrypted", "value": "encrypted"}
-        )
-        replace_compiler = cnp.Compiler(
-            _replace_impl,
-            {"state": "encrypted", "key": "encrypted", "value": "encrypted"}
-        )
-        query_compiler = cnp.Compiler(
-            _query_impl,
-            {"state": "encrypted", "key": "encrypted"}
-        )
 
-        print()
+class LoadedCircuit:
 
-        print("Compiling insertion circuit...")
-        start = time.time()
-        self._insert_circuit = insert_compiler.compile(inputset_ternary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+    client: cnp.Client
+    server: cnp.Server
 
-        print()
+    def __init__(self, server, keyset_cache_directory):
+        self.server = server
+        self.client = cnp.Client(server.client_specs, keyset_cache_directory)
 
-        print("Compiling replacement circuit...")
-        start = time.time()
-        self._replace_circuit = replace_compiler.compile(inputset_ternary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+    def keygen(self, force=False):
+        self.client.keygen(force)
 
-        print()
+    def encrypt_run_decrypt(self, *args):
+        result = self.server.run(self.client.encrypt(*args), self.client.evaluation_keys)
+        return self.client.decrypt(result)
 
-        print("Compiling query circuit...")
-        start = time.time()
-        self._query_circuit = query_compiler.compile(inputset_binary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
 
-        print()
+def compile_or_load(name, compiler, inputset, configuration, cache_location):
+    location = os.path.join(cache_location, f"{name}.zip")
 
-        print("Generating insertion keys...")
+    if os.path.exists(location):
+        print(f"Loading {name} circuit...")
         start = time.time()
-        self._insert_circuit.keygen()
+        circuit = LoadedCircuit(cnp.Server.load(location), configuration.insecure_key_cache_location)
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
+        return circuit
+
+    print(f"Compiling {name} circuit...")
+    start = time.time()
+    circuit = compiler.compile(inputset, configuration)
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    os.makedirs(cache_location, exist_ok=True)
+    partial_location = os.path.join(cache_location, f"{name}.partial.zip")
+    circuit.server.save(partial_location)
+    os.replace(partial_location, location)
+    return circuit
+
+
+def _configuration_hash():
+    circuit_source = "".join(
+        inspect.getsource(function)
+        for function in (_insert_impl, _replace_and_query_impl, _insert_many_impl, _query_many_impl, _build_circuits)
+    )
+    parameters = (
+        FLAGS_SHAPE, KEYS_SHAPE, VALUES_SHAPE, KEY_SIZE, VALUE_SIZE, CHUNK_SIZE, BATCH_SIZE,
+        keep_selected_lut.table.tolist(), importlib.metadata.version("concrete-numpy"),
+    )
+    return hashlib.blake2b((str(parameters) + circuit_source).encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=1)
+def _build_circuits(configuration_hash):
+    inputset_insert = [
+        (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64), # flags
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+            np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
+        )
+    ]
+    inputset_replace_and_query = [
+        (
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+            np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
+        )
+    ]
+    inputset_insert_many = [
+        (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64), # flags
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones((BATCH_SIZE, NUMBER_OF_KEY_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_keys
+            np.ones((BATCH_SIZE, NUMBER_OF_VALUE_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_values
+        )
+    ]
+    inputset_query_many = [
+        (
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones((BATCH_SIZE, NUMBER_OF_KEY_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_keys
+        )
+    ]
+
+    key_cache_location = os.path.join(".keys", configuration_hash)
+    circuit_cache_location = os.path.join(".circuits", configuration_hash)
+
+    configuration = cnp.Configuration(
+        enable_unsafe_features=True,
+        use_insecure_key_cache=True,
+        insecure_key_cache_location=key_cache_location,
+    )
+
+    insert_compiler = cnp.Compiler(
+        _insert_impl,
+        {"flags": "encrypted", "keys": "encrypted", "values": "encrypted", "key": "encrypted", "value": "encrypted"}
+    )
+    replace_and_query_compiler = cnp.Compiler(
+        _replace_and_query_impl,
+        {"keys": "encrypted", "values": "encrypted", "key": "encrypted", "value": "encrypted"}
+    )
+    insert_many_compiler = cnp.Compiler(
+        _insert_many_impl,
+        {
+            "flags": "encrypted", "keys": "encrypted", "values": "encrypted",
+            "batch_keys": "encrypted", "batch_values": "encrypted",
+        }
+    )
+    query_many_compiler = cnp.Compiler(
+        _query_many_impl,
+        {"keys": "encrypted", "values": "encrypted", "batch_keys": "encrypted"}
+    )
+
+    print()
+
+    insert_circuit = compile_or_load(
+        "insert", insert_compiler, inputset_insert, configuration, circuit_cache_location
+    )
+
+    print()
+
+    replace_and_query_circuit = compile_or_load(
+        "replace_and_query", replace_and_query_compiler, inputset_replace_and_query, configuration, circuit_cache_location
+    )
+
+    print()
+
+    insert_many_circuit = compile_or_load(
+        "insert_many", insert_many_compiler, inputset_insert_many, configuration, circuit_cache_location
+    )
+
+    print()
+
+    query_many_circuit = compile_or_load(
+        "query_many", query_many_compiler, inputset_query_many, configuration, circuit_cache_location
+    )
+
+    print()
+
+    print("Generating insertion keys...")
+    start = time.time()
+    insert_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating replacement/query keys...")
+    start = time.time()
+    replace_and_query_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating batched insertion keys...")
+    start = time.time()
+    insert_many_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating batched query keys...")
+    start = time.time()
+    query_many_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Warming up circuits...")
+    start = time.time()
+    for circuit, inputset in (
+        (insert_circuit, inputset_insert),
+        (replace_and_query_circuit, inputset_replace_and_query),
+        (insert_many_circuit, inputset_insert_many),
+        (query_many_circuit, inputset_query_many),
+    ):
+        circuit.encrypt_run_decrypt(*inputset[0])
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    return insert_circuit, replace_and_query_circuit, insert_many_circuit, query_many_circuit
 
-        print()
 
-        print("Generating replacement keys...")
-        start = time.time()
-        self._replace_circuit.keygen()
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+class KeyValueDatabase:
 
-        print()
+    _state: Tuple[np.ndarray, np.ndarray, np.ndarray]
 
-        print("Generating query keys...")
-        start = time.time()
-        self._query_circuit.keygen()
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+    _insert_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _replace_and_query_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _insert_many_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _query_many_circuit: Union[cnp.Circuit, LoadedCircuit]
+
+    def __init__(self):
+        self._state = (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64),
+            np.zeros(KEYS_SHAPE, dtype=np.int64),
+            np.zeros(VALUES_SHAPE, dtype=np.int64),
+        )
+
+        (
+            self._insert_circuit,
+            self._replace_and_query_circuit,
+            self._insert_many_circuit,
+            self._query_many_circuit,
+        ) = _build_circuits(_configuration_hash())
 
     def insert(self, key, value):
         print()
         print(f"Inserting...")
         start = time.time()
-        self._state = self._insert_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key), encode_value(value)
+        state = self._insert_circuit.encrypt_run_decrypt(
+            *self._state, encode_key(key), encode_value(value)
         )
+        self._state = split_state(state)
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
@@ -210,9 +366,11 @@ class KeyValueDatabase:
         print()
         print(f"Replacing...")
         start = time.time()
-        self._state = self._replace_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key), encode_value(value)
+        flags, keys, values = self._state
+        result = self._replace_and_query_circuit.encrypt_run_decrypt(
+            keys, values, encode_key(key), encode_value(value)
         )
+        self._state = (flags, keys, result[:-1, 1:])
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
@@ -220,9 +378,10 @@ class KeyValueDatabase:
         print()
         print(f"Querying...")
         start = time.time()
-        result = self._query_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key)
-        )
+        _, keys, values = self._state
+        result = self._replace_and_query_circuit.encrypt_run_decrypt(
+            keys, values, encode_key(key), np.zeros(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64)
+        )[-1]
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
@@ -231,6 +390,51 @@ class KeyValueDatabase:
 
         return decode(result[1:])
 
+    def insert_many(self, keys, values):
+        if len(keys) != len(values):
+            raise ValueError(f"Got {len(keys)} keys but {len(values)} values")
+
+        unused = NUMBER_OF_ENTRIES - int(np.sum(self._state[0]))
+        if len(keys) > unused:
+            raise ValueError(f"Cannot insert {len(keys)} entries, only {unused} entries are unused")
+
+        batched = len(keys) - len(keys) % BATCH_SIZE
+
+        print()
+        print(f"Inserting {batched} entries in batches...")
+        start = time.time()
+        for i in range(0, batched, BATCH_SIZE):
+            state = self._insert_many_circuit.encrypt_run_decrypt(
+                *self._state,
+                np.array([encode_key(key) for key in keys[i:i+BATCH_SIZE]]),
+                np.array([encode_value(value) for value in values[i:i+BATCH_SIZE]]),
+            )
+            self._state = split_state(state)
+        end = time.time()
+        print(f"(took {end - start:.3f} seconds)")
+
+        for key, value in zip(keys[batched:], values[batched:]):
+            self.insert(key, value)
+
+    def query_many(self, keys):
+        batched = len(keys) - len(keys) % BATCH_SIZE
+
+        print()
+        print(f"Querying {batched} keys in batches...")
+        start = time.time()
+        _, entry_keys, entry_values = self._state
+        results = []
+        for i in range(0, batched, BATCH_SIZE):
+            results.extend(self._query_many_circuit.encrypt_run_decrypt(
+                entry_keys, entry_values,
+                np.array([encode_key(key) for key in keys[i:i+BATCH_SIZE]]),
+            ))
+        end = time.time()
+        print(f"(took {end - start:.3f} seconds)")
+
+        values = [None if result[0] == 0 else decode(result[1:]) for result in results]
+        return values + [self.query(key) for key in keys[batched:]]
+
 
 db = KeyValueDatabase()
 
@@ -251,3 +455,20 @@ assert db.query(4) == None
 # Test: Replace/Query
 db.replace(3, 5)
 assert db.query(3) == 5
+
+# Test: Batched Insert/Query
+db.insert_many([7, 8, 9], [70, 80, 90])
+assert db.query_many([3, 7, 8, 4, 9]) == [5, 70, 80, None, 90]
+
+# Test: Batched Insert Errors
+try:
+    db.insert_many([10, 11], [100])
+    assert False
+except ValueError:
+    pass
+try:
+    db.insert_many([10], [100])
+    assert False
+except ValueError:
+    pass
+assert db.query_many([25, 10]) == [40, None]
@@ -1,9 +1,12 @@
 import concrete.numpy as cnp
 import numpy as np
+import os
 import time
 
 NUMBER_OF_ENTRIES = 5
 
+VIRTUAL = os.environ.get("KVSTORE_VIRTUAL") == "1"
+
 KEY_SIZE = 4
 VALUE_SIZE = 4
 CHUNK_SIZE = 4
@@ -11,6 +14,8 @@ CHUNK_SIZE = 4
 NUMBER_OF_KEY_CHUNKS = KEY_SIZE//CHUNK_SIZE
 NUMBER_OF_VALUE_CHUNKS = VALUE_SIZE//CHUNK_SIZE
 
+SHIFT = 1 << CHUNK_SIZE
+
 
 FLAG = 0
 KEY = slice(1, 1 + NUMBER_OF_KEY_CHUNKS)
@@ -28,34 +33,44 @@ configuration = cnp.Configuration(
     insecure_key_cache_location=".keys",
 )
 
-lut_zero = cnp.LookupTable([1, 0, 0, 0])
+lut_or = cnp.LookupTable([0, 1, 1, 1])
 
 lut2 = cnp.LookupTable(
-    [0 for _ in range(16)] + [i for i in range(16)]
+    [0 for _ in range(SHIFT)] + [i for i in range(SHIFT)]
+)
+lut2_not = cnp.LookupTable(
+    [i for i in range(SHIFT)] + [0 for _ in range(SHIFT)]
 )
 
 def _insert_impl(state, key, value):
     flags = state[:, FLAG]
-    
-    selection = cnp.zeros(NUMBER_OF_ENTRIES)
 
-    found = cnp.zero()
-    for i in range(NUMBER_OF_ENTRIES):
-        selection_i = lut_zero[(found * 2) + flags[i]]
+    # found[i] = 1 if any of the entries 0..i is unused (Kogge-Stone prefix-or)
+    found = 1 - flags
+    stride = 1
+    while stride < NUMBER_OF_ENTRIES:
+        shifted = cnp.zeros(NUMBER_OF_ENTRIES)
+        shifted[stride:] = found[:-stride]
+        found = lut_or[found + shifted]
+        stride *= 2
 
-        selection[i] = selection_i
-        found += selection_i
+    # found is monotone, so the first unused entry is where it steps from 0 to 1
+    found_before = cnp.zeros(NUMBER_OF_ENTRIES)
+    found_before[1:] = found[:-1]
 
-    diff = cnp.zeros(STATE_SHAPE)
-    diff[:, FLAG] = selection
+    selection = found - found_before
 
+    # unused entries are all zeros, so adding the masked key/value writes them
+    state[:, FLAG] = flags + selection
+
+    # key and value share the table and the selection, so they go through one lookup
     selection = selection.reshape((-1, 1))
-    key_diff = lut2[selection * (2 ** CHUNK_SIZE) + key]
-    val_diff = lut2[selection * (2 ** CHUNK_SIZE) + value]
-    
-    diff[:, KEY] = key_diff
-    diff[:, VALUE] = val_diff
-    return state + diff
+    key_and_value = np.concatenate([key, value])
+    update = lut2[selection * SHIFT + key_and_value]
+    state[:, KEY] = state[:, KEY] + update[:, :NUMBER_OF_KEY_CHUNKS]
+    state[:, VALUE] = state[:, VALUE] + update[:, NUMBER_OF_KEY_CHUNKS:]
+
+    return state
 
 # state = np.array([
 #     [1, 2, 1],
@@ -75,41 +90,23 @@ def _replace_impl(state, key, value):
     keys = state[:, KEY]
     values = state[:, VALUE]
 
-    selection = cnp.zeros(NUMBER_OF_ENTRIES)
-
-    for i in range(NUMBER_OF_ENTRIES):
-        selection[i] = (keys[i] - key == 0)
+    selection = (keys - key) == 0
 
-    inverse_selection = 1 - selection
+    new_value = lut2[selection * SHIFT + value] + lut2_not[selection * SHIFT + values]
 
-    selection = selection.reshape((-1, 1))
-    inverse_selection = inverse_selection.reshape((-1, 1))
-    
-
-    new_value = lut2[selection * (2 ** CHUNK_SIZE) + value] + lut2[inverse_selection * (2 ** CHUNK_SIZE) + values]
-
-    new_state = cnp.zeros(STATE_SHAPE)
-    new_state[:, FLAG] = state[:, FLAG]
-    new_state[:, KEY] = state[:, KEY]
-    new_state[:, VALUE] = new_value
+    state[:, VALUE] = new_value
 
-    return new_state
+    return state
 
 
 def _query_impl(state, key):
     keys = state[:, KEY]
     values = state[:, VALUE]
 
-
-    selection = cnp.zeros(NUMBER_OF_ENTRIES)
-
-    for i in range(NUMBER_OF_ENTRIES):
-        selection[i] = (keys[i] - key == 0)
-
+    selection = (keys - key) == 0
     found = np.sum(selection)
-    selection = selection.reshape((-1, 1))
 
-    val_diff = lut2[selection * (2 ** CHUNK_SIZE) + values]
+    val_diff = lut2[selection * SHIFT + values]
 
     result = np.sum(val_diff)
 
@@ -129,24 +126,24 @@ class KeyValueDatabase:
         inputset_binary = [
             (
                 np.ones(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
             ),
             (
                 np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
             ),
         ]
         
         inputset_ternary = [
             (
                 np.ones(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # value
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
             ),
             (
                 np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # value
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
             )
         ]
         configuration = cnp.Configuration(
@@ -154,7 +151,7 @@ class KeyValueDatabase:
             use_insecure_key_cache=True,
             insecure_key_cache_location=".keys",
             verbose=True,
-            virtual=True,
+            virtual=VIRTUAL,
         )
 
         self._state = np.zeros(STATE_SHAPE, dtype=np.int64)
@@ -15,11 +15,15 @@ assert VALUE_SIZE % CHUNK_SIZE == 0
 NUMBER_OF_KEY_CHUNKS = KEY_SIZE // CHUNK_SIZE
 NUMBER_OF_VALUE_CHUNKS = VALUE_SIZE // CHUNK_SIZE
 
+SHIFT = 1 << CHUNK_SIZE
+
 
 def encode(number: int, width: int) -> np.array:
-    binary_repr = np.binary_repr(number, width=width)
-    blocks = [binary_repr[i:i+CHUNK_SIZE] for i in range(0, len(binary_repr), CHUNK_SIZE)]
-    return np.array([int(block, 2) for block in blocks])
+    if not 0 <= number < 1 << width:
+        raise ValueError(f"{number} is not a non-negative integer that fits in {width} bits")
+
+    shifts = np.arange(width - CHUNK_SIZE, -CHUNK_SIZE, -CHUNK_SIZE)
+    return (number >> shifts) & ((1 << CHUNK_SIZE) - 1)
 
 def encode_key(number: int) -> np.array:
     return encode(number, width=KEY_SIZE)
@@ -28,22 +32,20 @@ def encode_value(number: int) -> np.array:
     return encode(number, width=VALUE_SIZE)
 
 def decode(encoded_number: np.array) -> int:
-    result = 0
-    for i in range(len(encoded_number)):
-        result += 2**(CHUNK_SIZE*i) * encoded_number[(len(encoded_number) - i) - 1]
-    return result
+    shifts = np.arange(len(encoded_number) - 1, -1, -1) * CHUNK_SIZE
+    return int((np.asarray(encoded_number, dtype=np.int64) << shifts).sum())
 
 
-keep_if_match_lut = cnp.LookupTable([0 for _ in range(16)] + [i for i in range(16)])
-keep_if_no_match_lut = cnp.LookupTable([i for i in range(16)] + [0 for _ in range(16)])
+keep_if_match_lut = cnp.LookupTable([0 for _ in range(SHIFT)] + [i for i in range(SHIFT)])
+keep_if_no_match_lut = cnp.LookupTable([i for i in range(SHIFT)] + [0 for _ in range(SHIFT)])
 
 def _replace_impl(key, value, candidate_key, candidate_value):
     match = np.sum((candidate_key - key) == 0) == NUMBER_OF_KEY_CHUNKS
 
-    packed_match_and_value = (2 ** CHUNK_SIZE) * match + value
+    packed_match_and_value = SHIFT * match + value
     value_if_match_else_zeros = keep_if_match_lut[packed_match_and_value]
 
-    packed_match_and_candidate_value = (2 ** CHUNK_SIZE) * match + candidate_value
+    packed_match_and_candidate_value = SHIFT * match + candidate_value
     zeros_if_match_else_candidate_value = keep_if_no_match_lut[packed_match_and_candidate_value]
 
     return value_if_match_else_zeros + zeros_if_match_else_candidate_value
@@ -51,7 +53,7 @@ def _replace_impl(key, value, candidate_key, candidate_value):
 def _query_impl(key, candidate_key, candidate_value):
     match = np.sum((candidate_key - key) == 0) == NUMBER_OF_KEY_CHUNKS
 
-    packed_match_and_candidate_value = (2 ** CHUNK_SIZE) * match + candidate_value
+    packed_match_and_candidate_value = SHIFT * match + candidate_value
     candidate_value_if_match_else_zeros = keep_if_match_lut[packed_match_and_candidate_value]
 
     return cnp.array([match, *candidate_value_if_match_else_zeros])
@@ -90,17 +92,17 @@ class KeyValueDatabase:
 
         replace_inputset = [
             (
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # value
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # candidate_key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # candidate_value
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # candidate_key
+                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # candidate_value
             )
         ]
         query_inputset = [
             (
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # candidate_key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # candidate_value
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # candidate_key
+                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # candidate_value
             )
         ]
 
@@ -1,4 +1,10 @@
+import functools
+import hashlib
+import importlib.metadata
+import inspect
+import os
 import time
+from typing import Tuple, Union
 
 import concrete.numpy as cnp
 import numpy as np
@@ -7,8 +13,15 @@ import numpy as np
 # The number of entries in the database
 NUMBER_OF_ENTRIES = 5
 # The number of bits in each chunk
+# Smaller chunks make each lookup table smaller, so each lookup is cheaper,
+# at the cost of more chunks, and so more lookups, per key and value
+# The widest values of the circuits are the packed selection and chunk (CHUNK_SIZE + 1 bits)
+# and the number of mismatching key chunks (enough bits to count to NUMBER_OF_KEY_CHUNKS)
 CHUNK_SIZE = 4
 
+# The number of requests processed by a single run of the batched circuits
+BATCH_SIZE = 2
+
 # The number of bits in the key and value
 KEY_SIZE = 32
 VALUE_SIZE = 32
@@ -21,32 +34,41 @@ assert VALUE_SIZE % CHUNK_SIZE == 0
 NUMBER_OF_KEY_CHUNKS = KEY_SIZE // CHUNK_SIZE
 NUMBER_OF_VALUE_CHUNKS = VALUE_SIZE // CHUNK_SIZE
 
-# The shape of the state as a tensor
-# Shape:
-# | Flag Size | Key Size | Value Size |
-# | 1         | 32/4 = 8 | 32/4 = 8   |
-STATE_SHAPE = (NUMBER_OF_ENTRIES, 1 + NUMBER_OF_KEY_CHUNKS + NUMBER_OF_VALUE_CHUNKS)
+# The multiplier that packs a selection bit above a chunk
+# Example (CHUNK_SIZE = 4):
+#   selection * SHIFT + chunk = 1 * 16 + 10 = 26
+SHIFT = 1 << CHUNK_SIZE
 
-# Indexers for each part of the state
-FLAG = 0
-KEY = slice(1, 1 + NUMBER_OF_KEY_CHUNKS)
-VALUE = slice(1 + NUMBER_OF_KEY_CHUNKS, None)
+# The shapes of the parts of the state
+# The state is stored as three separate tensors (flags, keys and values)
+# instead of a single table, so each part is its own circuit input
+# and the compiler can pick its bit width and parameters separately
+# Shape:
+# | Flags | Keys     | Values   |
+# | 1     | 32/4 = 8 | 32/4 = 8 |
+FLAGS_SHAPE = (NUMBER_OF_ENTRIES,)
+KEYS_SHAPE = (NUMBER_OF_ENTRIES, NUMBER_OF_KEY_CHUNKS)
+VALUES_SHAPE = (NUMBER_OF_ENTRIES, NUMBER_OF_VALUE_CHUNKS)
 
 
 
 ## Encode/Decode Functions for conversions from Int <-> Numpy Array
 
 # Encode a number into a numpy array
-# The number is encoded in binary and then split into chunks
-# Each chunk is then converted to an integer
-# The integers are then stored in a numpy array
+# The number is split into chunks of CHUNK_SIZE bits, most significant chunk first
+# Each chunk is extracted by shifting the number right and masking the low bits,
+# for all chunks at once using numpy broadcasting
+# Numbers that are negative or do not fit in width bits are rejected,
+# as the chunks would otherwise silently drop their high bits
 # Example:
 #   encode(10, 4) -> [1, 0, 1, 0]
 #   encode(11, 5) -> [0, 1, 0, 1, 1]
 def encode(number: int, width: int) -> np.array:
-    binary_repr = np.binary_repr(number, width=width)
-    blocks = [binary_repr[i:i+CHUNK_SIZE] for i in range(0, len(binary_repr), CHUNK_SIZE)]
-    return np.array([int(block, 2) for block in blocks])
+    if not 0 <= number < 1 << width:
+        raise ValueError(f"{number} is not a non-negative integer that fits in {width} bits")
+
+    shifts = np.arange(width - CHUNK_SIZE, -CHUNK_SIZE, -CHUNK_SIZE)
+    return (number >> shifts) & ((1 << CHUNK_SIZE) - 1)
 
 # Encode a number with the key size
 def encode_key(number: int) -> np.array:
@@ -56,15 +78,19 @@ def encode_value(number: int) -> np.array:
     return encode(number, width=VALUE_SIZE)
 
 # Decode a numpy array into a number
-# The numpy array is converted to integer
+# Each chunk is shifted back to its position and the chunks are summed
 # Example:
 #   decode([1, 0, 1, 0]) -> 10
 #   decode([0, 1, 0, 1, 1]) -> 11
 def decode(encoded_number: np.array) -> int:
-    result = 0
-    for i in range(len(encoded_number)):
-        result += 2**(CHUNK_SIZE*i) * encoded_number[(len(encoded_number) - i) - 1]
-    return result
+    shifts = np.arange(len(encoded_number) - 1, -1, -1) * CHUNK_SIZE
+    return int((np.asarray(encoded_number, dtype=np.int64) << shifts).sum())
+
+# Split a circuit output into the flags, keys and values of the state
+# The insertion circuits return the parts of the state concatenated
+# as | Flag | Key | Value |, as circuits can only have a single output
+def split_state(state: np.array) -> Tuple[np.array, np.array, np.array]:
+    return state[:, 0], state[:, 1:1 + NUMBER_OF_KEY_CHUNKS], state[:, 1 + NUMBER_OF_KEY_CHUNKS:]
 
 
 # The lookup table for the following function
@@ -78,26 +104,27 @@ def decode(encoded_number: np.array) -> int:
 # Example:
 #   keep_selected(i=0..15, 1) -> 0
 #   keep_selected(i=16..31, 0) -> i
-keep_selected_lut = cnp.LookupTable([0 for _ in range(16)] + [i for i in range(16)])
+keep_selected_lut = cnp.LookupTable([0 for _ in range(SHIFT)] + [i for i in range(SHIFT)])
 
 
 ## Circuit Implementation Functions
 # These functions are used to implement the kv store circuits.
-# Three circuits are implemented:
+# Four circuits are implemented:
 #   insert: Inserts a key value pair into the database
-#   replace: Replaces the value of a key in the database
-#   query: Queries the database for a key and returns the value
+#   replace_and_query: Replaces the value of a key in the database,
+#                      and queries the database for a key and returns the value
+#   insert_many: Inserts BATCH_SIZE key value pairs into the database
+#   query_many: Queries the database for BATCH_SIZE keys and returns their values
 
 # Insert a key value pair into the database
-# - state: The state of the database
+# - flags: The used bits of the entries of the database
+#          These bits are used to determine if an entry is used or not
+# - keys: The keys of the entries of the database
+# - values: The values of the entries of the database
 # - key: The key to insert
 # - value: The value to insert
-# Returns the updated state
-def _insert_impl(state, key, value):
-    # Get the used bit from the state
-    # This bit is used to determine if an entry is used or not
-    flags = state[:, FLAG]
-
+# Returns the updated flags, keys and values as a single array with | Flag | Key | Value | rows
+def _insert_impl(flags, keys, values, key, value):
     # Create a selection array
     # This array is used to select the first unused entry
     selection = cnp.zeros(NUMBER_OF_ENTRIES)
@@ -117,240 +144,478 @@ def _insert_impl(state, key, value):
 
         # Update the selection array
         selection[i] = is_selected
-        # Update the found bit, so all entries will be 
+        # Update the found bit, so all entries will be
         # skipped after the first unused entry is found
+        # is_selected can only be 1 while found is 0, so the addition never goes above 1
+        # and found stays a single bit without a saturating lookup table
         found += is_selected
 
-    # Create a state update array
-    state_update = cnp.zeros(STATE_SHAPE)
-    # Update the state update array with the selection array
-    state_update[:, FLAG] = selection
+    # Mark the selected entry as used
+    new_flags = flags + selection
 
     # Reshape the selection array to be able to use it as an index
     selection = selection.reshape((-1, 1))
 
-    # Create a packed selection and key array
-    # This array is used to update the key of the selected entry
-    packed_selection_and_key = (selection * (2 ** CHUNK_SIZE)) + key
-    key_update = keep_selected_lut[packed_selection_and_key]
-
-    # Create a packed selection and value array
-    # This array is used to update the value of the selected entry
-    packed_selection_and_value = selection * (2 ** CHUNK_SIZE) + value
-    value_update = keep_selected_lut[packed_selection_and_value]
-
-    # Update the state update array with the key and value update arrays
-    state_update[:, KEY] = key_update
-    state_update[:, VALUE] = value_update
-
-    # Update the state with the state update array
-    new_state = state + state_update
-    return new_state
-
-# Replace the value of a key in the database
-#   If the key is not in the database, nothing happens
-#   If the key is in the database, the value is replaced
-# - state: The state of the database
-# - key: The key to replace
-# - value: The value to replace
-# Returns the updated state
-def _replace_impl(state, key, value):
-    # Get the keys and values from the state
-    keys = state[:, KEY]
-    values = state[:, VALUE]
-
+    # Create a packed selection and key/value array
+    # This array is used to update the key and value of the selected entry
+    # The key and value use the same table with the same selection,
+    # so they are concatenated and go through a single lookup
+    key_and_value = np.concatenate([key, value])
+    packed_selection_and_key_and_value = selection * SHIFT + key_and_value
+    key_and_value_update = keep_selected_lut[packed_selection_and_key_and_value]
+
+    # Split the update back into keys and values
+    # Unused entries are all zeros, so adding the kept key and value writes them
+    new_keys = keys + key_and_value_update[:, :NUMBER_OF_KEY_CHUNKS]
+    new_values = values + key_and_value_update[:, NUMBER_OF_KEY_CHUNKS:]
+
+    # Concatenate the flags, keys and values into a single output,
+    # as circuits can only have one output, it is split back by split_state
+    return np.concatenate([new_flags.reshape((-1, 1)), new_keys, new_values], axis=1)
+
+# Replace the value of a key in the database, and query the database for the key
+#   Replacement and query share the whole key comparison, so they are
+#   implemented as a single circuit
+#   Circuits can only have a single output, so the updated values and the query result
+#   are returned in one array, and each operation only uses the part it needs
+#   If the key is not in the database, the values are unchanged and found is 0
+#   If the key is in the database, the value is replaced and found is 1
+#   The flags are not needed, so they are not an input of the circuit
+# - keys: The keys of the entries of the database
+# - values: The values of the entries of the database
+# - key: The key to replace or query
+# - value: The value to replace with (ignored by queries)
+# Returns an array with NUMBER_OF_ENTRIES + 1 rows in the following format:
+#   [selected, value] for each entry, then [found, value] for the query
+#   selected: 1 if the entry has the key, 0 otherwise
+#   value (entry rows): The value of the entry after replacement
+#   found: 1 if the key was found, 0 otherwise
+#   value (last row): The value of the key before replacement if the key was found, 0 otherwise
+def _replace_and_query_impl(keys, values, key, value):
     # Create a selection array
     # This array is used to select the entry with the given key
-    # The selection array is created by comparing the keys in the state
-    # with the given key, and only setting the entry to 1 if the keys are equal
+    # The selection array is created by counting the chunks where the keys of the entries
+    # differ from the given key (hamming distance over chunks), and only setting
+    # the entry to 1 if there are no differing chunks
     # Example:
     #   keys = [[1, 0, 1, 0], [0, 1, 0, 1, 1]]
     #   key = [1, 0, 1, 0]
+    #   mismatches = [0, 4]
     #   selection = [1, 0]
-    selection = (np.sum((keys - key) == 0, axis=1) == NUMBER_OF_KEY_CHUNKS).reshape((-1, 1))
+    mismatches = np.sum((keys - key) != 0, axis=1)
+    selection = (mismatches == 0).reshape((-1, 1))
+
+    # Create a found bit
+    # This bit is used to determine if the key was found
+    # The found bit is set to 1 if the key was found, and 0 otherwise
+    found = np.sum(selection, axis=0, keepdims=True)
+
+    # Create a packed selection and value array
+    # This array is used to get the value of the selected entry
+    packed_selection_and_values = selection * SHIFT + values
+    value_selection = keep_selected_lut[packed_selection_and_values]
+
+    # Sum the value selection array to get the queried value
+    queried_value = np.sum(value_selection, axis=0, keepdims=True)
 
     # Create a packed selection and value array
     # This array is used to update the value of the selected entry
-    packed_selection_and_value = selection * (2 ** CHUNK_SIZE) + value
+    packed_selection_and_value = selection * SHIFT + value
     set_value = keep_selected_lut[packed_selection_and_value]
 
-    # Create an inverse selection array
-    # This array is used to pick entries that are not selected
+    # Remove the value of the selected entry from the values
+    # This keeps the values of the entries that are not selected,
+    # and reuses the value selection instead of a second lookup
     # Example:
-    #   selection = [1, 0, 0]
-    #   inverse_selection = [0, 1, 1]
-    inverse_selection = 1 - selection
-
-    # Create a packed inverse selection and value array
-    # This array is used to keep the value of the entries that are not selected
-    packed_inverse_selection_and_values = inverse_selection * (2 ** CHUNK_SIZE) + values
-    kept_values = keep_selected_lut[packed_inverse_selection_and_values]
+    #   values = [[1, 2], [3, 4]]
+    #   value_selection = [[1, 2], [0, 0]]
+    #   kept_values = [[0, 0], [3, 4]]
+    kept_values = values - value_selection
 
-    # Update the values of the state with the new values
+    # Write the new value into the kept values
     new_values = kept_values + set_value
-    state[:, VALUE] = new_values
 
-    return state
-
-# Query the database for a key and return the value
-# - state: The state of the database
-# - key: The key to query
-# Returns an array with the following format:
+    # Return the selection with the updated values of each entry,
+    # followed by the found bit with the queried value as the last row
+    # The selection column pads the entry rows to the width of the query row
+    entries = np.concatenate([selection, new_values], axis=1)
+    query_result = np.concatenate([found, queried_value], axis=1)
+    return np.concatenate([entries, query_result], axis=0)
+
+# Insert BATCH_SIZE key value pairs into the database in a single circuit run
+# - flags: The used bits of the entries of the database
+# - keys: The keys of the entries of the database
+# - values: The values of the entries of the database
+# - batch_keys: The keys to insert, one row per key
+# - batch_values: The values to insert, one row per value
+# Returns the updated flags, keys and values as a single array with | Flag | Key | Value | rows
+def _insert_many_impl(flags, keys, values, batch_keys, batch_values):
+    # Invert the used bits to get the unused bits
+    unused = 1 - flags
+
+    # Create a rank array
+    # rank[i] is the number of unused entries among the first i + 1 entries
+    # It is computed with additions only, so no lookup tables are used
+    # Example:
+    #   unused = [0, 1, 0, 1, 1]
+    #   rank = [0, 1, 1, 2, 3]
+    rank = cnp.zeros(NUMBER_OF_ENTRIES)
+    running = cnp.zero()
+    for i in range(NUMBER_OF_ENTRIES):
+        running += unused[i]
+        rank[i] = running
+
+    # The b-th pair of the batch goes to the unused entry with rank b + 1
+    # The packed rank and unused bit is compared against that target
+    # for every pair of the batch at once, giving a (BATCH_SIZE, NUMBER_OF_ENTRIES)
+    # selection array with at most one 1 per row and per column
+    packed_rank_and_unused = rank * 2 + unused
+    targets = (np.arange(BATCH_SIZE) * 2 + 3).reshape((-1, 1))
+    selection = (packed_rank_and_unused - targets) == 0
+
+    # An entry is used after the update if any pair of the batch selected it
+    new_flags = flags + np.sum(selection, axis=0)
+
+    # Concatenate the keys and values of the batch, as in _insert_impl,
+    # and reshape them and the selection so they broadcast
+    # over (BATCH_SIZE, NUMBER_OF_ENTRIES, NUMBER_OF_CHUNKS)
+    selection = selection.reshape((BATCH_SIZE, NUMBER_OF_ENTRIES, 1))
+    batch_keys_and_values = np.concatenate([batch_keys, batch_values], axis=1).reshape(
+        (BATCH_SIZE, 1, NUMBER_OF_KEY_CHUNKS + NUMBER_OF_VALUE_CHUNKS)
+    )
+
+    # Keep each key and value only in the entry selected for it,
+    # and sum over the batch to collapse them into a single update
+    packed_selection_and_keys_and_values = selection * SHIFT + batch_keys_and_values
+    key_and_value_update = np.sum(keep_selected_lut[packed_selection_and_keys_and_values], axis=0)
+
+    # Split the update back into keys and values
+    new_keys = keys + key_and_value_update[:, :NUMBER_OF_KEY_CHUNKS]
+    new_values = values + key_and_value_update[:, NUMBER_OF_KEY_CHUNKS:]
+
+    # Concatenate the flags, keys and values into a single output,
+    # as circuits can only have one output, it is split back by split_state
+    return np.concatenate([new_flags.reshape((-1, 1)), new_keys, new_values], axis=1)
+
+# Query the database for BATCH_SIZE keys in a single circuit run
+# - keys: The keys of the entries of the database
+# - values: The values of the entries of the database
+# - batch_keys: The keys to query, one row per key
+# Returns an array with one row per key in the following format:
 #   [found, value]
 #   found: 1 if the key was found, 0 otherwise
 #   value: The value of the key if the key was found, 0 otherwise
-def _query_impl(state, key):
-    # Get the keys and values from the state
-    keys = state[:, KEY]
-    values = state[:, VALUE]
-
+def _query_many_impl(keys, values, batch_keys):
     # Create a selection array
-    # This array is used to select the entry with the given key
-    # The selection array is created by comparing the keys in the state
-    # with the given key, and only setting the entry to 1 if the keys are equal
-    # Example:
-    #   keys = [[1, 0, 1, 0], [0, 1, 0, 1, 1]]
-    #   key = [1, 0, 1, 0]
-    #   selection = [1, 0]
-    selection = (np.sum((keys - key) == 0, axis=1) == NUMBER_OF_KEY_CHUNKS).reshape((-1, 1))
+    # This is the selection of _replace_and_query_impl computed for every key of the batch,
+    # the batch is reshaped so it broadcasts against the keys of the entries
+    batch_keys = batch_keys.reshape((BATCH_SIZE, 1, NUMBER_OF_KEY_CHUNKS))
+    mismatches = np.sum((keys - batch_keys) != 0, axis=2)
+    selection = (mismatches == 0).reshape((BATCH_SIZE, NUMBER_OF_ENTRIES, 1))
 
-    # Create a found bit
-    # This bit is used to determine if the key was found
-    # The found bit is set to 1 if the key was found, and 0 otherwise
-    found = np.sum(selection)
+    # Create a found bit for every key of the batch
+    found = np.sum(selection, axis=1)
 
     # Create a packed selection and value array
-    # This array is used to get the value of the selected entry
-    packed_selection_and_values = selection * (2 ** CHUNK_SIZE) + values
+    # This array is used to get the value of the selected entry for every key
+    packed_selection_and_values = selection * SHIFT + values
     value_selection = keep_selected_lut[packed_selection_and_values]
 
-    # Sum the value selection array to get the value
-    value = np.sum(value_selection, axis=0)
+    # Sum the value selection array over the entries to get the values
+    value = np.sum(value_selection, axis=1)
 
-    # Return the found bit and the value
-    return cnp.array([found, *value])
+    # Return the found bits and the values, one row per key
+    return np.concatenate([found, value], axis=1)
 
 
-class KeyValueDatabase:
+## Circuit Caching
+# Compiling the circuits is the slowest part of starting the database,
+# so compiled circuits are saved to disk and loaded back on the next start
+
+class LoadedCircuit:
     """
-    A key-value database that uses fully homomorphic encryption circuits to store the data.
+    A compiled circuit loaded from disk.
+    It provides the parts of the cnp.Circuit interface used by the database.
     """
 
-    # The state of the database, it holds all the 
-    # keys and values as a table of entries
-    _state: np.ndarray
-
-    # The circuits used to implement the database
-    _insert_circuit: cnp.Circuit
-    _replace_circuit: cnp.Circuit
-    _query_circuit: cnp.Circuit
-
-    def __init__(self):
-        # Initialize the state to all zeros
-        self._state = np.zeros(STATE_SHAPE, dtype=np.int64)
-
-        ## Input sets for initialization of the circuits
-        # The input sets are used to initialize the circuits with the correct parameters
-
-        # The input set for the query circuit
-        inputset_binary = [
-            (
-                np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-            )
-        ]
-        # The input set for the insert and replace circuits
-        inputset_ternary = [
-            (
-                np.zeros(STATE_SHAPE, dtype=np.int64), # state
-                np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # key
-                np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (2**CHUNK_SIZE - 1), # value
-            )
-        ]
-
-        ## Circuit compilation
-
-        # Create a configuration for the compiler
-        configuration = cnp.Configuration(
-            enable_unsafe_features=True,
-            use_insecure_key_cache=True,
-            insecure_key_cache_location=".keys",
-            # virtual=True,
+    # The client holds the keys, and encrypts the inputs and decrypts the outputs
+    client: cnp.Client
+    # The server holds the compiled circuit, and runs it on encrypted inputs
+    server: cnp.Server
+
+    def __init__(self, server, keyset_cache_directory):
+        self.server = server
+        self.client = cnp.Client(server.client_specs, keyset_cache_directory)
+
+    # Generate the keys for the circuit, or load them from the key cache
+    def keygen(self, force=False):
+        self.client.keygen(force)
+
+    # Encrypt the inputs, run the circuit and decrypt the outputs
+    def encrypt_run_decrypt(self, *args):
+        result = self.server.run(self.client.encrypt(*args), self.client.evaluation_keys)
+        return self.client.decrypt(result)
+
+
+# Compile a circuit, or load it if it was compiled before
+# - name: The name of the circuit, used as its file name in the cache
+# - compiler: The compiler of the circuit
+# - inputset: The input set to compile the circuit with
+# - configuration: The configuration to compile the circuit with
+# - cache_location: The directory the compiled circuits are saved to
+# Returns the compiled or loaded circuit
+def compile_or_load(name, compiler, inputset, configuration, cache_location):
+    location = os.path.join(cache_location, f"{name}.zip")
+
+    # Load the circuit if it was saved before
+    if os.path.exists(location):
+        print(f"Loading {name} circuit...")
+        start = time.time()
+        circuit = LoadedCircuit(cnp.Server.load(location), configuration.insecure_key_cache_location)
+        end = time.time()
+        print(f"(took {end - start:.3f} seconds)")
+        return circuit
+
+    # Otherwise compile the circuit
+    print(f"Compiling {name} circuit...")
+    start = time.time()
+    circuit = compiler.compile(inputset, configuration)
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    # And save it so the next start can load it
+    # The circuit is saved to a temporary file first and then moved into place,
+    # so a crash while saving never leaves a truncated circuit to load
+    os.makedirs(cache_location, exist_ok=True)
+    partial_location = os.path.join(cache_location, f"{name}.partial.zip")
+    circuit.server.save(partial_location)
+    os.replace(partial_location, location)
+    return circuit
+
+
+# Hash the database parameters and the circuit code
+# The circuit code is the source of the circuit functions and of _build_circuits,
+# which holds the input sets and the compiler configuration,
+# and the version of the compiler is included as it changes the compiled circuits
+# The key and circuit cache locations are named after this hash,
+# so changing any of them results in a fresh set of keys and circuits
+def _configuration_hash():
+    circuit_source = "".join(
+        inspect.getsource(function)
+        for function in (_insert_impl, _replace_and_query_impl, _insert_many_impl, _query_many_impl, _build_circuits)
+    )
+    parameters = (
+        FLAGS_SHAPE, KEYS_SHAPE, VALUES_SHAPE, KEY_SIZE, VALUE_SIZE, CHUNK_SIZE, BATCH_SIZE,
+        keep_selected_lut.table.tolist(), importlib.metadata.version("concrete-numpy"),
+    )
+    return hashlib.blake2b((str(parameters) + circuit_source).encode()).hexdigest()[:16]
+
+# Compile or load the circuits of the database, and generate or load their keys
+# - configuration_hash: The hash of the database configuration
+# The configuration is fixed by the module constants, so the circuits are built
+# once per process and shared by every database created in it
+# Returns the insert, replace_and_query, insert_many and query_many circuits
+@functools.lru_cache(maxsize=1)
+def _build_circuits(configuration_hash):
+    ## Input sets for initialization of the circuits
+    # The input sets are used to initialize the circuits with the correct parameters
+
+    # The input set for the insert circuit
+    inputset_insert = [
+        (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64), # flags
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+            np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
         )
-
-        # Create the compilers for the circuits
-        # Each compiler is provided with
-        # - The implementation of the circuit
-        # - The inputs and their corresponding types of the circuit
-        #  - "encrypted": The input is encrypted
-        #  - "plain": The input is not encrypted
-        insert_compiler = cnp.Compiler(
-            _insert_impl,
-            {"state": "encrypted", "key": "encrypted", "value": "encrypted"}
+    ]
+    # The input set for the replace/query circuit
+    inputset_replace_and_query = [
+        (
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones(NUMBER_OF_KEY_CHUNKS, dtype=np.int64) * (SHIFT - 1), # key
+            np.ones(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64) * (SHIFT - 1), # value
         )
-        replace_compiler = cnp.Compiler(
-            _replace_impl,
-            {"state": "encrypted", "key": "encrypted", "value": "encrypted"}
+    ]
+    # The input set for the batched insert circuit
+    inputset_insert_many = [
+        (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64), # flags
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones((BATCH_SIZE, NUMBER_OF_KEY_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_keys
+            np.ones((BATCH_SIZE, NUMBER_OF_VALUE_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_values
         )
-        query_compiler = cnp.Compiler(
-            _query_impl,
-            {"state": "encrypted", "key": "encrypted"}
+    ]
+    # The input set for the batched query circuit
+    inputset_query_many = [
+        (
+            np.zeros(KEYS_SHAPE, dtype=np.int64), # keys
+            np.zeros(VALUES_SHAPE, dtype=np.int64), # values
+            np.ones((BATCH_SIZE, NUMBER_OF_KEY_CHUNKS), dtype=np.int64) * (SHIFT - 1), # batch_keys
         )
+    ]
+
+    ## Circuit compilation
+
+    # Create key and circuit cache locations for the configuration of the database
+    key_cache_location = os.path.join(".keys", configuration_hash)
+    circuit_cache_location = os.path.join(".circuits", configuration_hash)
+
+    # Create a configuration for the compiler
+    configuration = cnp.Configuration(
+        enable_unsafe_features=True,
+        use_insecure_key_cache=True,
+        insecure_key_cache_location=key_cache_location,
+        # virtual=True,
+    )
+
+    # Create the compilers for the circuits
+    # Each compiler is provided with
+    # - The implementation of the circuit
+    # - The inputs and their corresponding types of the circuit
+    #  - "encrypted": The input is encrypted
+    #  - "plain": The input is not encrypted
+    insert_compiler = cnp.Compiler(
+        _insert_impl,
+        {"flags": "encrypted", "keys": "encrypted", "values": "encrypted", "key": "encrypted", "value": "encrypted"}
+    )
+    replace_and_query_compiler = cnp.Compiler(
+        _replace_and_query_impl,
+        {"keys": "encrypted", "values": "encrypted", "key": "encrypted", "value": "encrypted"}
+    )
+    insert_many_compiler = cnp.Compiler(
+        _insert_many_impl,
+        {
+            "flags": "encrypted", "keys": "encrypted", "values": "encrypted",
+            "batch_keys": "encrypted", "batch_values": "encrypted",
+        }
+    )
+    query_many_compiler = cnp.Compiler(
+        _query_many_impl,
+        {"keys": "encrypted", "values": "encrypted", "batch_keys": "encrypted"}
+    )
+
+
+    ## Compile the circuits
+    # The circuits are compiled with the input set and the configuration,
+    # or loaded from the circuit cache if they were compiled before
+
+    print()
+
+    insert_circuit = compile_or_load(
+        "insert", insert_compiler, inputset_insert, configuration, circuit_cache_location
+    )
+
+    print()
+
+    replace_and_query_circuit = compile_or_load(
+        "replace_and_query", replace_and_query_compiler, inputset_replace_and_query, configuration, circuit_cache_location
+    )
+
+    print()
+
+    insert_many_circuit = compile_or_load(
+        "insert_many", insert_many_compiler, inputset_insert_many, configuration, circuit_cache_location
+    )
+
+    print()
+
+    query_many_circuit = compile_or_load(
+        "query_many", query_many_compiler, inputset_query_many, configuration, circuit_cache_location
+    )
+
+    print()
+
+    ## Generate the keys for the circuits
+    # The keys are seaparately generated for each circuit
+    # Keys of a configuration that was already used are loaded from the key cache
+    # instead of being generated again
+    print("Generating insertion keys...")
+    start = time.time()
+    insert_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating replacement/query keys...")
+    start = time.time()
+    replace_and_query_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating batched insertion keys...")
+    start = time.time()
+    insert_many_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    print("Generating batched query keys...")
+    start = time.time()
+    query_many_circuit.keygen()
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    print()
+
+    ## Warm up the circuits
+    # The first run of each circuit is slower than the following ones,
+    # as the keys are paged into memory on first use
+    # Each circuit is run once on a sample of its input set, and the result is discarded,
+    # so the first real operation does not pay for it
+    print("Warming up circuits...")
+    start = time.time()
+    for circuit, inputset in (
+        (insert_circuit, inputset_insert),
+        (replace_and_query_circuit, inputset_replace_and_query),
+        (insert_many_circuit, inputset_insert_many),
+        (query_many_circuit, inputset_query_many),
+    ):
+        circuit.encrypt_run_decrypt(*inputset[0])
+    end = time.time()
+    print(f"(took {end - start:.3f} seconds)")
+
+    return insert_circuit, replace_and_query_circuit, insert_many_circuit, query_many_circuit
 
 
-        ## Compile the circuits
-        # The circuits are compiled with the input set and the configuration
-
-        print()
-
-        print("Compiling insertion circuit...")
-        start = time.time()
-        self._insert_circuit = insert_compiler.compile(inputset_ternary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
-
-        print()
-
-        print("Compiling replacement circuit...")
-        start = time.time()
-        self._replace_circuit = replace_compiler.compile(inputset_ternary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
-
-        print()
-
-        print("Compiling query circuit...")
-        start = time.time()
-        self._query_circuit = query_compiler.compile(inputset_binary, configuration)
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
-
-        print()
-
-        ## Generate the keys for the circuits
-        # The keys are seaparately generated for each circuit
-
-        print("Generating insertion keys...")
-        start = time.time()
-        self._insert_circuit.keygen()
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+class KeyValueDatabase:
+    """
+    A key-value database that uses fully homomorphic encryption circuits to store the data.
+    """
 
-        print()
+    # The state of the database, it holds the flags, keys and values
+    # of all the entries as three separate tensors
+    _state: Tuple[np.ndarray, np.ndarray, np.ndarray]
 
-        print("Generating replacement keys...")
-        start = time.time()
-        self._replace_circuit.keygen()
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+    # The circuits used to implement the database
+    # They are either freshly compiled, or loaded from the circuit cache
+    _insert_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _replace_and_query_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _insert_many_circuit: Union[cnp.Circuit, LoadedCircuit]
+    _query_many_circuit: Union[cnp.Circuit, LoadedCircuit]
 
-        print()
+    def __init__(self):
+        # Initialize the state to all zeros
+        self._state = (
+            np.zeros(FLAGS_SHAPE, dtype=np.int64),
+            np.zeros(KEYS_SHAPE, dtype=np.int64),
+            np.zeros(VALUES_SHAPE, dtype=np.int64),
+        )
 
-        print("Generating query keys...")
-        start = time.time()
-        self._query_circuit.keygen()
-        end = time.time()
-        print(f"(took {end - start:.3f} seconds)")
+        # Build the circuits, or reuse them if a database was already created in this process
+        (
+            self._insert_circuit,
+            self._replace_and_query_circuit,
+            self._insert_many_circuit,
+            self._query_many_circuit,
+        ) = _build_circuits(_configuration_hash())
 
     # The following methods are used to interact with the database
     # They are used to insert, replace and query the database
@@ -365,9 +630,10 @@ class KeyValueDatabase:
         print()
         print(f"Inserting...")
         start = time.time()
-        self._state = self._insert_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key), encode_value(value)
+        state = self._insert_circuit.encrypt_run_decrypt(
+            *self._state, encode_key(key), encode_value(value)
         )
+        self._state = split_state(state)
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
@@ -375,28 +641,34 @@ class KeyValueDatabase:
     # - key: The key to replace
     # - value: The new value to insert with the key
     # The key and value are encoded before they are inserted
-    # The state of the database is updated with the new key-value pair
+    # The values of the database are updated with the new value
+    # The query row of the replacement/query circuit output is ignored
     def replace(self, key, value):
         print()
         print(f"Replacing...")
         start = time.time()
-        self._state = self._replace_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key), encode_value(value)
+        flags, keys, values = self._state
+        result = self._replace_and_query_circuit.encrypt_run_decrypt(
+            keys, values, encode_key(key), encode_value(value)
         )
+        self._state = (flags, keys, result[:-1, 1:])
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
     # Query the database for a key
     # - key: The key to query
     # The key is encoded before it is queried
+    # The replacement/query circuit is run with a zero value,
+    # and only its query row is used so the state is never modified by queries
     # Returns the value associated with the key or None if the key is not found
     def query(self, key):
         print()
         print(f"Querying...")
         start = time.time()
-        result = self._query_circuit.encrypt_run_decrypt(
-            self._state, encode_key(key)
-        )
+        _, keys, values = self._state
+        result = self._replace_and_query_circuit.encrypt_run_decrypt(
+            keys, values, encode_key(key), np.zeros(NUMBER_OF_VALUE_CHUNKS, dtype=np.int64)
+        )[-1]
         end = time.time()
         print(f"(took {end - start:.3f} seconds)")
 
@@ -405,6 +677,65 @@ class KeyValueDatabase:
 
         return decode(result[1:])
 
+    # Insert many key-value pairs into the database
+    # - keys: The keys to insert
+    # - values: The values to insert, in the same order as the keys
+    # The pairs are inserted BATCH_SIZE at a time with the batched insertion circuit,
+    # the remaining pairs that do not fill a whole batch are inserted one by one
+    # Raises ValueError if the number of keys and values differ,
+    # or if there are not enough unused entries for all the pairs,
+    # as the circuits would otherwise drop the pairs that do not fit
+    def insert_many(self, keys, values):
+        if len(keys) != len(values):
+            raise ValueError(f"Got {len(keys)} keys but {len(values)} values")
+
+        # The state is decrypted after every operation, so the used entries can be counted
+        unused = NUMBER_OF_ENTRIES - int(np.sum(self._state[0]))
+        if len(keys) > unused:
+            raise ValueError(f"Cannot insert {len(keys)} entries, only {unused} entries are unused")
+
+        batched = len(keys) - len(keys) % BATCH_SIZE
+
+        print()
+        print(f"Inserting {batched} entries in batches...")
+        start = time.time()
+        for i in range(0, batched, BATCH_SIZE):
+            state = self._insert_many_circuit.encrypt_run_decrypt(
+                *self._state,
+                np.array([encode_key(key) for key in keys[i:i+BATCH_SIZE]]),
+                np.array([encode_value(value) for value in values[i:i+BATCH_SIZE]]),
+            )
+            self._state = split_state(state)
+        end = time.time()
+        print(f"(took {end - start:.3f} seconds)")
+
+        for key, value in zip(keys[batched:], values[batched:]):
+            self.insert(key, value)
+
+    # Query the database for many keys
+    # - keys: The keys to query
+    # The keys are queried BATCH_SIZE at a time with the batched query circuit,
+    # the remaining keys that do not fill a whole batch are queried one by one
+    # Returns the values associated with the keys, None for the keys that are not found
+    def query_many(self, keys):
+        batched = len(keys) - len(keys) % BATCH_SIZE
+
+        print()
+        print(f"Querying {batched} keys in batches...")
+        start = time.time()
+        _, entry_keys, entry_values = self._state
+        results = []
+        for i in range(0, batched, BATCH_SIZE):
+            results.extend(self._query_many_circuit.encrypt_run_decrypt(
+                entry_keys, entry_values,
+                np.array([encode_key(key) for key in keys[i:i+BATCH_SIZE]]),
+            ))
+        end = time.time()
+        print(f"(took {end - start:.3f} seconds)")
+
+        values = [None if result[0] == 0 else decode(result[1:]) for result in results]
+        return values + [self.query(key) for key in keys[batched:]]
+
 
 ## Test: Initialization
 # Initialize the database
@@ -442,3 +773,28 @@ db.replace(3, 5)
 # Query the database for the key 3
 # The value 5 should be returned
 assert db.query(3) == 5
+
+## Test: Batched Insert/Query
+# Insert (key: 7, value: 70), (key: 8, value: 80) and (key: 9, value: 90) into the database
+# The first two pairs are inserted as a batch, the last one on its own
+db.insert_many([7, 8, 9], [70, 80, 90])
+# Query the database for the keys 3, 7, 8, 4 and 9
+# The first four keys are queried as two batches, the last one on its own
+# The values 5, 70, 80, None and 90 should be returned
+assert db.query_many([3, 7, 8, 4, 9]) == [5, 70, 80, None, 90]
+
+## Test: Batched Insert Errors
+# Inserting a different number of keys and values should raise a ValueError
+try:
+    db.insert_many([10, 11], [100])
+    assert False
+except ValueError:
+    pass
+# The database is full, so inserting more pairs should raise a ValueError
+try:
+    db.insert_many([10], [100])
+    assert False
+except ValueError:
+    pass
+# The failed insertions should not modify the database
+assert db.query_many([25, 10]) == [40, None]